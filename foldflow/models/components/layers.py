@@ -1,32 +1,15 @@
 import math
-from typing import Callable, List, Optional
+from contextlib import nullcontext
+from functools import lru_cache
+from inspect import isfunction
+from typing import Callable, List, Optional, Tuple
 
-import numpy as np
 import torch
-from einops import rearrange, repeat
-from scipy.stats import truncnorm
-from torch import Tensor, einsum
-from torch.nn import LayerNorm, TransformerEncoderLayer
+from torch import Tensor
 from torch.nn import functional as F
 import torch.nn as nn
 
 
-def _standardize(kernel):
-    """
-    Makes sure that Var(W) = 1 and E[W] = 0
-    """
-    eps = 1e-6
-
-    if len(kernel.shape) == 3:
-        axis = [0, 1]  # last dimension is output dimension
-    else:
-        axis = 1
-
-    var, mean = torch.var_mean(kernel, dim=axis, unbiased=True, keepdim=True)
-    kernel = (kernel - mean) / (var + eps) ** 0.5
-    return kernel
-
-
 def he_orthogonal_init(tensor):
     """
     Generate a weight matrix with variance according to He initialization.
@@ -36,16 +19,26 @@ def he_orthogonal_init(tensor):
     "Dropout: a simple way to prevent neural networks from overfitting",
     "Exact solutions to the nonlinear dynamics of learning in deep linear neural networks")
     """
-    tensor = torch.nn.init.orthogonal_(tensor)
-
     if len(tensor.shape) == 3:
-        fan_in = tensor.shape[:-1].numel()
+        # Flatten the fan-in dims into a 2-D view; it shares storage with the
+        # parameter, so the in-place ops below need no reshape back.
+        kernel = tensor.view(-1, tensor.shape[-1])
+        axis = 0  # last dimension is output dimension
+        fan_in = kernel.shape[0]
     else:
-        fan_in = tensor.shape[1]
+        kernel = tensor
+        axis = 1
+        fan_in = kernel.shape[1]
+
+    torch.nn.init.orthogonal_(kernel)
 
     with torch.no_grad():
-        tensor.data = _standardize(tensor.data)
-        tensor.data *= (1 / fan_in) ** 0.5
+        eps = 1e-6
+        var, mean = torch.var_mean(kernel, dim=axis, unbiased=True, keepdim=True)
+        # Standardization (Var(W) = 1, E[W] = 0) and the 1/sqrt(fan_in) factor
+        # folded into a single rescale.
+        scale = torch.rsqrt(var + eps) * (1 / fan_in) ** 0.5
+        kernel.sub_(mean).mul_(scale)
 
     return tensor
 
@@ -71,15 +64,18 @@ class Dense(torch.nn.Module):
 
         self.linear = torch.nn.Linear(in_features, out_features, bias=bias)
         self.reset_parameters()
-        self.weight = self.linear.weight
-        self.bias = self.linear.bias
 
         if isinstance(activation, str):
             activation = activation.lower()
         if activation in ["swish", "silu"]:
-            self._activation = ScaledSiLU()
+            self._scaled_silu = True
+            # 0-dim buffer so the scale lives on the device with the weights;
+            # a Python float would be re-uploaded on every multiply
+            self.register_buffer(
+                "_silu_scale", torch.tensor(_SILU_SCALE), persistent=False
+            )
         elif activation is None:
-            self._activation = torch.nn.Identity()
+            self._scaled_silu = False
         else:
             raise NotImplementedError(
                 "Activation function not implemented for GemNet (yet)."
@@ -90,20 +86,37 @@ class Dense(torch.nn.Module):
         if self.linear.bias is not None:
             self.linear.bias.data.fill_(0)
 
+    @property
+    def weight(self):
+        return self.linear.weight
+
+    @property
+    def bias(self):
+        return self.linear.bias
+
     def forward(self, x):
         x = self.linear(x)
-        x = self._activation(x)
+        if self._scaled_silu:
+            # scaled SiLU inlined; mul_ runs in-place on the fresh SiLU output
+            x = F.silu(x).mul_(self._silu_scale)
         return x
 
 
+_SILU_SCALE = 1 / 0.6
+
+
 class ScaledSiLU(torch.nn.Module):
     def __init__(self):
         super().__init__()
-        self.scale_factor = 1 / 0.6
-        self._activation = torch.nn.SiLU()
+        self.register_buffer(
+            "scale_factor", torch.tensor(_SILU_SCALE), persistent=False
+        )
 
     def forward(self, x):
-        return self._activation(x) * self.scale_factor
+        return F.silu(x) * self.scale_factor
+
+
+_INV_SQRT_2 = 1 / math.sqrt(2.0)
 
 
 class ResidualLayer(torch.nn.Module):
@@ -128,13 +141,14 @@ class ResidualLayer(torch.nn.Module):
                 for i in range(nLayers)
             ]
         )
-        self.inv_sqrt_2 = 1 / (2.0**0.5)
+        self.register_buffer(
+            "inv_sqrt_2", torch.tensor(_INV_SQRT_2), persistent=False
+        )
 
     def forward(self, inputs):
         x = self.dense_mlp(inputs)
-        x = inputs + x
-        x = x * self.inv_sqrt_2
-        return x
+        # add + scale in-place on the fresh sum, one elementwise pass
+        return torch.add(inputs, x).mul_(self.inv_sqrt_2)
 
 
 class EfficientInteractionDownProjection(torch.nn.Module):
@@ -184,7 +198,8 @@ class EfficientInteractionDownProjection(torch.nn.Module):
         rbf_env, sph = tbf
         # (num_spherical, nEdges, num_radial), (nEdges, Kmax, num_spherical) ;  Kmax = maximum number of neighbors of the edges
 
-        # MatMul: mul + sum over num_radial
+        # MatMul: mul + sum over num_radial; the permute afterwards is a
+        # stride-only view, not a copy
         rbf_W1 = torch.matmul(
             rbf_env, self.weight
         )  # (num_spherical, nEdges , emb_size_interm)
@@ -194,60 +209,28 @@ class EfficientInteractionDownProjection(torch.nn.Module):
         return rbf_W1, sph
 
 
-class ResidualLayer(torch.nn.Module):
-    """
-    Residual block with output scaled by 1/sqrt(2).
-
-    Parameters
-    ----------
-        units: int
-            Output embedding size.
-        nLayers: int
-            Number of dense layers.
-        activation: str
-            Name of the activation function to use.
-    """
-
-    def __init__(self, units: int, nLayers: int = 2, activation=None, name=None):
-        super().__init__()
-        self.dense_mlp = torch.nn.Sequential(
-            *[
-                Dense(units, units, activation=activation, bias=False)
-                for i in range(nLayers)
-            ]
-        )
-        self.inv_sqrt_2 = 1 / (2.0**0.5)
-
-    def forward(self, inputs):
-        x = self.dense_mlp(inputs)
-        x = inputs + x
-        x = x * self.inv_sqrt_2
-        return x
+@lru_cache(maxsize=256)
+def _perm_indices(ndim: int, inds: Tuple[int, ...]) -> Tuple[int, ...]:
+    zero_index = ndim - len(inds)
+    return tuple(range(zero_index)) + tuple(zero_index + i for i in inds)
 
 
 def permute_final_dims(tensor: torch.Tensor, inds: List[int]):
-    zero_index = -1 * len(inds)
-    first_inds = list(range(len(tensor.shape[:zero_index])))
-    return tensor.permute(first_inds + [zero_index + i for i in inds])
+    return tensor.permute(_perm_indices(tensor.ndim, tuple(inds)))
 
 
 def flatten_final_dims(t: torch.Tensor, no_dims: int):
     return t.reshape(t.shape[:-no_dims] + (-1,))
 
 
+softplus_inverse_1 = 0.541324854612918
+
+
 def ipa_point_weights_init_(weights):
     with torch.no_grad():
-        softplus_inverse_1 = 0.541324854612918
         weights.fill_(softplus_inverse_1)
 
 
-def _prod(nums):
-    out = 1
-    for n in nums:
-        out = out * n
-    return out
-
-
 def _calculate_fan(linear_weight_shape, fan="fan_in"):
     fan_out, fan_in = linear_weight_shape
 
@@ -263,18 +246,14 @@ def _calculate_fan(linear_weight_shape, fan="fan_in"):
     return f
 
 
+# std of a standard normal truncated to [-2, 2], i.e. scipy truncnorm.std(-2, 2, 0, 1)
+truncnorm_std_const = 0.8796256610342398
+
+
 def trunc_normal_init_(weights, scale=1.0, fan="fan_in"):
-    shape = weights.shape
-    f = _calculate_fan(shape, fan)
-    scale = scale / max(1, f)
-    a = -2
-    b = 2
-    std = math.sqrt(scale) / truncnorm.std(a=a, b=b, loc=0, scale=1)
-    size = _prod(shape)
-    samples = truncnorm.rvs(a=a, b=b, loc=0, scale=std, size=size)
-    samples = np.reshape(samples, shape)
-    with torch.no_grad():
-        weights.copy_(torch.tensor(samples, device=weights.device))
+    f = _calculate_fan(weights.shape, fan)
+    std = math.sqrt(scale / max(1, f)) / truncnorm_std_const
+    torch.nn.init.trunc_normal_(weights, mean=0.0, std=std, a=-2.0 * std, b=2.0 * std)
 
 
 def lecun_normal_init_(weights):
@@ -286,7 +265,10 @@ def he_normal_init_(weights):
 
 
 def glorot_uniform_init_(weights):
-    torch.nn.init.xavier_uniform_(weights, gain=1)
+    fan_out, fan_in = weights.shape
+    a = math.sqrt(6.0 / (fan_in + fan_out))
+    with torch.no_grad():
+        weights.uniform_(-a, a)
 
 
 def final_init_(weights):
@@ -300,7 +282,9 @@ def gating_init_(weights):
 
 
 def normal_init_(weights):
-    torch.nn.init.kaiming_normal_(weights, nonlinearity="linear")
+    fan_in = _calculate_fan(weights.shape, "fan_in")
+    with torch.no_grad():
+        weights.normal_(0, 1.0 / math.sqrt(fan_in))
 
 
 class Linear(torch.nn.Linear):
@@ -376,7 +360,7 @@ def exists(val):
 
 
 def uniq(arr):
-    return {el: True for el in arr}.keys()
+    return dict.fromkeys(arr).keys()
 
 
 def default(val, d):
@@ -385,130 +369,217 @@ def default(val, d):
     return d() if isfunction(d) else d
 
 
+def fused_ln_linear(x: Tensor, norm: nn.LayerNorm, linear: nn.Linear) -> Tensor:
+    """
+    Apply ``norm`` followed by ``linear`` without materializing the normalized
+    activation. The LayerNorm affine transform is static, so it is folded into
+    the Linear weight/bias; only the per-sample standardization touches ``x``
+    before the matmul, saving one full activation write+read per call.
+    """
+    var, mean = torch.var_mean(x, dim=-1, unbiased=False, keepdim=True)
+    x = (x - mean) * torch.rsqrt(var + norm.eps)
+    weight = linear.weight * norm.weight
+    bias = F.linear(norm.bias, linear.weight, linear.bias)
+    return F.linear(x, weight, bias)
+
+
+@lru_cache(maxsize=None)
+def _max_neg_value(dtype: torch.dtype) -> float:
+    return -torch.finfo(dtype).max
+
+
+def _split_heads(t: Tensor, h: int) -> Tensor:
+    # (b, n, h * d) -> (b, h, n, d) via view + transpose; no einops planning
+    # overhead and no copy for a known-shape layout change
+    b, n, _ = t.shape
+    return t.view(b, n, h, -1).transpose(1, 2)
+
+
+def _autocast_ctx(t: Tensor, enabled: bool):
+    # opt-in bf16 autocast so the GEMMs hit tensor cores; autocast keeps
+    # softmax and LayerNorm in fp32. No-op unless requested, on CUDA, and on
+    # bf16-capable hardware.
+    if enabled and t.is_cuda and torch.cuda.is_bf16_supported():
+        return torch.autocast(device_type="cuda", dtype=torch.bfloat16)
+    return nullcontext()
+
+
 # Implement Cross Attention Layer
 # Code Taken from https://github.com/CompVis/latent-diffusion/blob/main/ldm/modules/attention.py
 class CrossAttention(nn.Module):
-    def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0.0):
+    def __init__(
+        self,
+        query_dim,
+        context_dim=None,
+        heads=8,
+        dim_head=64,
+        dropout=0.0,
+        compile_forward=False,
+        autocast_bf16=False,
+    ):
         super().__init__()
+        self.autocast_bf16 = autocast_bf16
         inner_dim = dim_head * heads
         context_dim = default(context_dim, query_dim)
 
-        self.scale = dim_head**-0.5
         self.heads = heads
 
-        self.to_q = nn.Linear(query_dim, inner_dim, bias=False)
-        self.to_k = nn.Linear(context_dim, inner_dim, bias=False)
-        self.to_v = nn.Linear(context_dim, inner_dim, bias=False)
+        # for self-attention, one 3x-wide GEMM beats three small ones; the
+        # fused weight is the single source of truth, sliced for the
+        # explicit-context path, so no duplicate parameters to keep in sync
+        self.fused_qkv = context_dim == query_dim
+        if self.fused_qkv:
+            self.to_qkv = nn.Linear(query_dim, 3 * inner_dim, bias=False)
+        else:
+            self.to_q = nn.Linear(query_dim, inner_dim, bias=False)
+            self.to_k = nn.Linear(context_dim, inner_dim, bias=False)
+            self.to_v = nn.Linear(context_dim, inner_dim, bias=False)
 
         self.to_out = nn.Sequential(
             nn.Linear(inner_dim, query_dim), nn.Dropout(dropout)
         )
 
+        if compile_forward:
+            # specialize the attention body per input shape: pointwise ops get
+            # fused into the matmul epilogues and launch overhead amortizes
+            # into a CUDA graph; leave off (the default) when debugging
+            self._attend = torch.compile(
+                self._attend, mode="reduce-overhead", dynamic=False
+            )
+
     def forward(self, x, context=None, mask=None):
-        h = self.heads
+        with _autocast_ctx(x, self.autocast_bf16):
+            return self._attend(x, context, mask)
 
-        q = self.to_q(x)
-        context = default(context, x)
-        k = self.to_k(context)
-        v = self.to_v(context)
+    def _attend(self, x, context=None, mask=None):
+        h = self.heads
 
-        q, k, v = map(lambda t: rearrange(t, "b n (h d) -> (b h) n d", h=h), (q, k, v))
+        if self.fused_qkv:
+            if context is None:
+                q, k, v = self.to_qkv(x).chunk(3, dim=-1)
+            else:
+                w_q, w_k, w_v = self.to_qkv.weight.chunk(3, dim=0)
+                q = F.linear(x, w_q)
+                k = F.linear(context, w_k)
+                v = F.linear(context, w_v)
+        else:
+            context = default(context, x)
+            q = self.to_q(x)
+            k = self.to_k(context)
+            v = self.to_v(context)
 
-        sim = einsum("b i d, b j d -> b i j", q, k) * self.scale
+        q, k, v = map(lambda t: _split_heads(t, h), (q, k, v))
 
+        attn_mask = None
         if exists(mask):
-            mask = rearrange(mask, "b ... -> b (...)")
-            max_neg_value = -torch.finfo(sim.dtype).max
-            mask = repeat(mask, "b j -> (b h) () j", h=h)
-            sim.masked_fill_(~mask, max_neg_value)
+            mask = mask.reshape(mask.shape[0], -1)[:, None, None, :]
+            if mask.dtype == torch.bool:
+                # additive float bias, broadcast as (B, 1, 1, N): 0 where
+                # attended, -max where masked; avoids repeating a bool mask
+                # per head
+                attn_mask = torch.zeros_like(mask, dtype=q.dtype)
+                attn_mask.masked_fill_(~mask, _max_neg_value(q.dtype))
+            else:
+                # already an additive float bias (e.g. a canonicalized key
+                # padding mask from the encoder layer)
+                attn_mask = mask
 
-        # attention, what we cannot get enough of
-        attn = sim.softmax(dim=-1)
+        # Fused attention (FlashAttention / mem-efficient kernel on CUDA);
+        # applies the dim_head ** -0.5 scale internally and never materializes
+        # the (N, N) similarity matrix.
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=0.0)
 
-        out = einsum("b i j, b j d -> b i d", attn, v)
-        out = rearrange(out, "(b h) n d -> b n (h d)", h=h)
+        b, _, n, _ = out.shape
+        out = out.transpose(1, 2).reshape(b, n, -1)
         return self.to_out(out)
 
 
 # Custom Pytorch Transformer Encoder Layer
-class CrossAttentionTransformerEncoderLayer(TransformerEncoderLayer):
+class CrossAttentionTransformerEncoderLayer(nn.Module):
     def __init__(
-        self, d_model, nhead, dim_feedforward=2048, dropout=0.1, activation="relu"
+        self,
+        d_model,
+        nhead,
+        dim_feedforward=2048,
+        dropout=0.1,
+        activation="relu",
+        norm_first=False,
+        autocast_bf16=False,
     ):
-        super().__init__(d_model, nhead, dim_feedforward, dropout, activation)
-        self.attn = CrossAttention(d_model, nhead, dropout=dropout)
+        super().__init__()
+        if d_model % nhead != 0:
+            raise ValueError("d_model must be divisible by nhead")
+        self.autocast_bf16 = autocast_bf16
+        self.attn = CrossAttention(
+            d_model,
+            heads=nhead,
+            dim_head=d_model // nhead,
+            dropout=dropout,
+            autocast_bf16=autocast_bf16,
+        )
+        self.linear1 = nn.Linear(d_model, dim_feedforward)
+        self.linear2 = nn.Linear(dim_feedforward, d_model)
+        self.norm_first = norm_first
         self.dropout = nn.Dropout(dropout)
-        self.activation = _get_activation_fn(activation)
         self.norm1 = nn.LayerNorm(d_model)
         self.norm2 = nn.LayerNorm(d_model)
-        self.norm3 = nn.LayerNorm(d_model)
         self.dropout1 = nn.Dropout(dropout)
         self.dropout2 = nn.Dropout(dropout)
-        self.dropout3 = nn.Dropout(dropout)
 
-        if activation is F.relu or isinstance(activation, torch.nn.ReLU):
-            self.activation_relu_or_gelu = 1
-        elif activation is F.gelu or isinstance(activation, torch.nn.GELU):
-            self.activation_relu_or_gelu = 2
-        else:
-            self.activation_relu_or_gelu = 0
+        # resolve the activation to a plain callable once at init
+        if isinstance(activation, str):
+            resolved = {"relu": F.relu, "gelu": F.gelu}.get(activation)
+            if resolved is None:
+                raise ValueError(
+                    f"activation should be relu/gelu, not {activation}"
+                )
+            activation = resolved
         self.activation = activation
 
     def forward(
         self, src, src_mask=None, src_key_padding_mask=None, is_causal: bool = False
     ):
-        src_key_padding_mask = F._canonical_mask(
-            mask=src_key_padding_mask,
-            mask_name="src_key_padding_mask",
-            other_type=F._none_or_dtype(src_mask),
-            other_name="src_mask",
-            target_type=src.dtype,
-        )
+        if src_mask is not None or is_causal:
+            raise NotImplementedError(
+                "CrossAttentionTransformerEncoderLayer only supports key padding "
+                "masks; src_mask / is_causal attention is not wired into "
+                "CrossAttention"
+            )
 
-        src_mask = F._canonical_mask(
-            mask=src_mask,
-            mask_name="src_mask",
-            other_type=None,
-            other_name="",
-            target_type=src.dtype,
-            check_other=False,
-        )
+        # canonicalization is pure Python validation; skip it in the common
+        # unmasked case
+        if src_key_padding_mask is not None:
+            src_key_padding_mask = F._canonical_mask(
+                mask=src_key_padding_mask,
+                mask_name="src_key_padding_mask",
+                other_type=None,
+                other_name="",
+                target_type=src.dtype,
+            )
 
         x = src
-        if self.norm_first:
-            x = x + self._attn_block(
-                self.norm1(x), src_mask, src_key_padding_mask, is_causal=is_causal
-            )
-            x = x + self._ff_block(self.norm2(x))
-        else:
-            x = self.norm1(
-                x
-                + self._sa_block(x, src_mask, src_key_padding_mask, is_causal=is_causal)
-            )
-            x = self.norm2(x + self._ff_block(x))
+        with _autocast_ctx(x, self.autocast_bf16):
+            if self.norm_first:
+                x = x + self._attn_block(self.norm1(x), src_key_padding_mask)
+                x = x + self._ff_block_fused(x)
+            else:
+                x = self.norm1(x + self._attn_block(x, src_key_padding_mask))
+                x = self.norm2(x + self._ff_block(x))
 
         return x
 
     # self-attention block
-    def _attn_block(
-        self,
-        x: Tensor,
-        attn_mask: Optional[Tensor],
-        key_padding_mask: Optional[Tensor],
-        is_causal: bool = False,
-    ) -> Tensor:
-        x = self.attn(
-            x,
-            x,
-            x,
-            attn_mask=attn_mask,
-            key_padding_mask=key_padding_mask,
-            need_weights=False,
-            is_causal=is_causal,
-        )[0]
+    def _attn_block(self, x: Tensor, key_padding_mask: Optional[Tensor]) -> Tensor:
+        x = self.attn(x, mask=key_padding_mask)
         return self.dropout1(x)
 
     # feed forward block
     def _ff_block(self, x: Tensor) -> Tensor:
         x = self.linear2(self.dropout(self.activation(self.linear1(x))))
         return self.dropout2(x)
+
+    # feed forward block with norm2 folded into linear1 (pre-norm path)
+    def _ff_block_fused(self, x: Tensor) -> Tensor:
+        x = fused_ln_linear(x, self.norm2, self.linear1)
+        x = self.linear2(self.dropout(self.activation(x)))
+        return self.dropout2(x)
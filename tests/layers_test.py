@@ -0,0 +1,80 @@
+import torch
+import torch.nn.functional as F
+
+from foldflow.models.components.layers import CrossAttention, fused_ln_linear
+
+
+def _reference_attention(attn, x, context=None, mask=None):
+    # pre-SDPA CrossAttention.forward: explicit einsum QK^T, scale,
+    # masked_fill, softmax, einsum over V in (b h) n d layout
+    h = attn.heads
+    ctx = x if context is None else context
+    if attn.fused_qkv:
+        w_q, w_k, w_v = attn.to_qkv.weight.chunk(3, dim=0)
+        q, k, v = F.linear(x, w_q), F.linear(ctx, w_k), F.linear(ctx, w_v)
+    else:
+        q, k, v = attn.to_q(x), attn.to_k(ctx), attn.to_v(ctx)
+
+    def split(t):
+        b, n, _ = t.shape
+        return t.view(b, n, h, -1).transpose(1, 2).reshape(b * h, n, -1)
+
+    q, k, v = split(q), split(k), split(v)
+    scale = q.shape[-1] ** -0.5
+    sim = torch.einsum("b i d, b j d -> b i j", q, k) * scale
+    if mask is not None:
+        m = mask[:, None, None, :].expand(mask.shape[0], h, 1, mask.shape[-1])
+        m = m.reshape(mask.shape[0] * h, 1, mask.shape[-1])
+        sim = sim.masked_fill(~m, -torch.finfo(sim.dtype).max)
+    out = torch.einsum("b i j, b j d -> b i d", sim.softmax(dim=-1), v)
+    b, n = x.shape[0], x.shape[1]
+    out = out.view(b, h, n, -1).transpose(1, 2).reshape(b, n, -1)
+    return attn.to_out(out)
+
+
+def test_cross_attention_matches_reference():
+    torch.manual_seed(0)
+    attn = CrossAttention(query_dim=32, heads=4, dim_head=8).eval()
+    x = torch.randn(2, 6, 32)
+    context = torch.randn(2, 5, 32)
+    self_mask = torch.rand(2, 6) > 0.3
+    ctx_mask = torch.rand(2, 5) > 0.3
+    self_mask[:, 0] = True
+    ctx_mask[:, 0] = True
+
+    cases = [(None, None), (None, self_mask), (context, None), (context, ctx_mask)]
+    with torch.no_grad():
+        for ctx, mask in cases:
+            expected = _reference_attention(attn, x, context=ctx, mask=mask)
+            got = attn(x, context=ctx, mask=mask)
+            assert torch.allclose(got, expected, atol=1e-5)
+
+
+def test_cross_attention_unfused_matches_reference():
+    torch.manual_seed(0)
+    attn = CrossAttention(query_dim=32, context_dim=16, heads=4, dim_head=8).eval()
+    assert not attn.fused_qkv
+    x = torch.randn(2, 6, 32)
+    context = torch.randn(2, 5, 16)
+    mask = torch.rand(2, 5) > 0.3
+    mask[:, 0] = True
+
+    with torch.no_grad():
+        for m in (None, mask):
+            expected = _reference_attention(attn, x, context=context, mask=m)
+            got = attn(x, context=context, mask=m)
+            assert torch.allclose(got, expected, atol=1e-5)
+
+
+def test_fused_ln_linear_matches_unfused():
+    torch.manual_seed(0)
+    norm = torch.nn.LayerNorm(32)
+    with torch.no_grad():
+        norm.weight.uniform_(0.5, 1.5)
+        norm.bias.uniform_(-0.5, 0.5)
+    linear = torch.nn.Linear(32, 64)
+    x = torch.randn(4, 16, 32)
+
+    expected = linear(norm(x))
+    fused = fused_ln_linear(x, norm, linear)
+    assert torch.allclose(fused, expected, atol=1e-5)